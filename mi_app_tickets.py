@@ -1,13 +1,24 @@
 import sqlite3
-import qrcode
+import segno
 import io
 import hmac
 import hashlib
 import base64
+import binascii
 import os
 import logging
-from flask import Flask, jsonify, request, send_file, g, abort
+import orjson
+import click
+import functools
+import queue
+import threading
+import atexit
+import shutil
+import time
+from flask import Flask, jsonify, request, send_file, send_from_directory, g, abort, make_response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
@@ -17,36 +28,152 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Serializa las respuestas JSON con orjson (implementado en C)"""
+
+    # Mismo comportamiento que el proveedor por defecto de Flask: fechas y dataclasses
+    # pasan por default() (fechas en formato HTTP, no ISO) y las claves no-str se
+    # convierten a texto en vez de fallar
+    OPCIONES = (
+        orjson.OPT_PASSTHROUGH_DATETIME
+        | orjson.OPT_PASSTHROUGH_DATACLASS
+        | orjson.OPT_NON_STR_KEYS
+    )
+
+    def dumps(self, obj, **kwargs):
+        opciones = self.OPCIONES
+        if kwargs.get('sort_keys', self.sort_keys):
+            opciones |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=opciones).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Los archivos estáticos (escáner) se pueden revalidar con 304 durante una hora
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+# Compresión de respuestas (HTML del escáner y JSON grandes); las respuestas
+# pequeñas no compensan el costo. gunicorn no comprime, así que no hay doble compresión.
+app.config['COMPRESS_MIN_SIZE'] = 256
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+# El escáner se envía como archivo (streaming): Flask-Compress cambia su ETag
+# (":br"/":gzip"), así que debe volver a evaluar If-None-Match para dar 304
+app.config['COMPRESS_STREAMING_ENDPOINT_CONDITIONAL'] = ['static', 'serve_scanner']
+Compress(app)
 # CORRECCIÓN: Permite conexiones desde CUALQUIER origen (*)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 # --- Configuración ---
 DATABASE = 'tickets.db'
+DB_POOL_SIZE = 5
+DB_CACHED_STATEMENTS = 256
+DB_POOL_TIMEOUT = 5             # Segundos de espera por una conexión libre
+WEBHOOK_BATCH_SIZE = 50         # Máximo de pedidos por transacción
+WEBHOOK_BATCH_WINDOW = 0.05     # Segundos que se espera para agrupar pedidos
+WEBHOOK_SHUTDOWN_TIMEOUT = 20   # Segundos para vaciar la cola al apagar (gunicorn da 30)
+PEDIDOS_FALLIDOS = 'pedidos_fallidos.jsonl'  # Pedidos que no se pudieron guardar
 SHOPIFY_API_SECRET = os.environ.get("SHOPIFY_API_SECRET")
 
 if not SHOPIFY_API_SECRET:
     logger.warning("SHOPIFY_API_SECRET no está configurado. Los webhooks fallarán.")
 
+HMAC_HEADER_LENGTH = 44  # base64 de un digest SHA-256 (32 bytes)
+
+# Plantilla HMAC con la clave ya procesada; cada webhook trabaja sobre una copia
+_HMAC_TEMPLATE = (
+    hmac.new(SHOPIFY_API_SECRET.encode('utf-8'), digestmod=hashlib.sha256)
+    if SHOPIFY_API_SECRET else None
+)
+
 # --- Funciones de la Base de Datos (SQLite) ---
 
+# Pool de conexiones persistentes: evita abrir/cerrar SQLite en cada petición
+# y mantiene la caché de páginas "caliente" entre peticiones.
+_pool = None
+_pool_lock = threading.Lock()
+
+def _crear_conexion():
+    """Crea una conexión configurada para el pool"""
+    # isolation_level=None: sin transacciones implícitas de Python; cada sentencia
+    # es autocommit salvo donde abrimos BEGIN IMMEDIATE explícitamente.
+    # cached_statements: las sentencias preparadas se reutilizan por texto exacto,
+    # así que el SQL debe ser siempre literal con parámetros "?" (nunca f-strings).
+    db = sqlite3.connect(
+        DATABASE,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=DB_CACHED_STATEMENTS
+    )
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("PRAGMA temp_store=MEMORY")
+    db.execute("PRAGMA cache_size=-20000")
+    db.execute("PRAGMA mmap_size=268435456")
+    return db
+
+def _obtener_pool():
+    """Devuelve el pool, creándolo la primera vez"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                nuevo_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+                for _ in range(DB_POOL_SIZE):
+                    nuevo_pool.put(_crear_conexion())
+                _pool = nuevo_pool
+    return _pool
+
+def _cerrar_pool():
+    """Cierra todas las conexiones libres del pool y lo descarta"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            while True:
+                try:
+                    _pool.get_nowait().close()
+                except queue.Empty:
+                    break
+            _pool = None
+
 def get_db():
-    """Abre una conexión a la base de datos"""
+    """Toma una conexión del pool para la petición actual"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        pool = _obtener_pool()
+        try:
+            db = pool.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            # Mejor fallar rápido que dejar la petición colgada para siempre
+            logger.error("Error: No hay conexiones libres en el pool de la base de datos.")
+            abort(503)
+        g._database_pool = pool
+        g._database = db
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """Cierra la conexión al final de la petición"""
-    db = getattr(g, '_database', None)
+    """Devuelve la conexión al pool al final de la petición"""
+    db = g.pop('_database', None)
+    pool = g.pop('_database_pool', None)
     if db is not None:
+        _devolver_conexion(pool, db)
+
+def _devolver_conexion(pool, db):
+    """Devuelve una conexión al pool del que salió"""
+    if db.in_transaction:
+        db.rollback()
+    # Si el pool fue reiniciado mientras tanto, la conexión ya no sirve
+    if pool is _pool:
+        pool.put(db)
+    else:
         db.close()
 
 def init_db():
     """Crea la tabla de la base de datos si no existe"""
+    # Reinicia el pool por si el archivo de la base de datos fue recreado
+    _cerrar_pool()
     with app.app_context():
         db = get_db()
         cursor = db.cursor()
@@ -62,8 +189,14 @@ def init_db():
             )
             """
         )
-        db.commit()
+        # WAL es persistente en el archivo: el escáner puede leer mientras el webhook escribe
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # ticket_id ya tiene el índice de la PRIMARY KEY; orden_id no
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tickets_orden_id ON tickets(orden_id)")
         logger.info("Base de datos inicializada y tabla 'tickets' asegurada.")
+    # Sin conexiones abiertas al terminar: si gunicorn hace fork después de importar
+    # (--preload), cada worker abre las suyas en vez de heredar las del master
+    _cerrar_pool()
 
 # --- Función de Seguridad del Webhook ---
 def verificar_webhook(data, hmac_header):
@@ -72,19 +205,246 @@ def verificar_webhook(data, hmac_header):
         logger.error("Error: No se encontró la cabecera HMAC.")
         return False
 
-    if not SHOPIFY_API_SECRET:
+    if _HMAC_TEMPLATE is None:
         logger.error("Error: SHOPIFY_API_SECRET no configurado.")
         return False
 
-    digest = hmac.new(
-        SHOPIFY_API_SECRET.encode('utf-8'),
-        data,
-        hashlib.sha256
-    ).digest()
+    firma = _HMAC_TEMPLATE.copy()
+    firma.update(data)
+    digest = firma.digest()
+
+    # Una firma SHA-256 en base64 siempre mide 44 caracteres: descartamos
+    # cabeceras de otro tamaño antes de decodificarlas
+    if len(hmac_header) != HMAC_HEADER_LENGTH:
+        logger.error("Error: La cabecera HMAC no tiene la longitud esperada.")
+        return False
+
+    # Comparamos los bytes crudos: se decodifica la cabecera en vez de codificar el digest
+    try:
+        recibido = base64.b64decode(hmac_header, validate=True)
+    except (binascii.Error, ValueError):
+        logger.error("Error: La cabecera HMAC no es base64 válido.")
+        return False
+
+    if len(recibido) != len(digest):
+        logger.error("Error: La cabecera HMAC no tiene la longitud esperada.")
+        return False
+
+    return hmac.compare_digest(digest, recibido)
 
-    computed_hmac = base64.b64encode(digest)
 
-    return hmac.compare_digest(computed_hmac, hmac_header.encode('utf-8'))
+# --- Escritura de pedidos en segundo plano ---
+# El webhook solo verifica y encola; un único hilo escritor guarda los tickets
+# agrupando los pedidos que llegan juntos en una sola transacción.
+_cola_pedidos = queue.Queue()
+_FIN_COLA = object()  # Señal para que el hilo escritor termine
+_fallidos_lock = threading.Lock()
+# El hilo escritor se arranca en el primer pedido (_asegurar_writer), ya dentro del
+# worker: así funciona también si gunicorn hace fork después de importar el módulo
+_writer = None
+_writer_lock = threading.Lock()
+
+def _tickets_del_pedido(pedido):
+    """Devuelve las filas de tickets (ticket_id, sku, email, orden) de un pedido"""
+    cliente_email = pedido.get('email')
+    orden_id = pedido.get('id')
+    orden_str = str(orden_id)
+    tickets = []
+
+    for item in pedido.get('line_items', []):
+        sku = item.get('sku')
+        cantidad = item.get('quantity')
+
+        # (Usaremos la lógica de SKU por ahora, es más seguro)
+        if sku:
+            prefijo = f"TICKET-{orden_id}-{item.get('id')}-"
+            for i in range(1, cantidad + 1):
+                tickets.append((prefijo + str(i), sku, cliente_email, orden_str))
+
+    return tickets
+
+def _guardar_pedidos(pedidos):
+    """Inserta los tickets de varios pedidos en una sola transacción"""
+    tickets = []
+    resumen = []
+    for pedido in pedidos:
+        tickets_pedido = _tickets_del_pedido(pedido)
+        resumen.append((pedido.get('id'), len(tickets_pedido)))
+        tickets.extend(tickets_pedido)
+
+    pool = _obtener_pool()
+    # Si no hay conexión libre, queue.Empty hace fallar el lote y el pedido queda en PEDIDOS_FALLIDOS
+    db = pool.get(timeout=DB_POOL_TIMEOUT)
+    try:
+        # Un solo INSERT preparado y una sola transacción para todo el lote
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany(
+            """
+            INSERT INTO tickets (ticket_id, evento_sku, cliente_email, orden_id, usado)
+            VALUES (?, ?, ?, ?, 0)
+            ON CONFLICT(ticket_id) DO NOTHING
+            """,
+            tickets
+        )
+        db.execute("COMMIT")
+    finally:
+        _devolver_conexion(pool, db)
+
+    # Un solo log por pedido (formato perezoso con %) en vez de uno por ticket
+    for orden_id, cantidad in resumen:
+        logger.info("Pedido %s: %d tickets guardados", orden_id, cantidad)
+
+def _guardar_fallido(pedido, error):
+    """Guarda el pedido que no se pudo escribir para poder reprocesarlo luego"""
+    # Shopify ya recibió 200 y no va a reintentar: sin este registro el pedido se pierde
+    logger.error(f"Error al procesar el pedido {pedido.get('id')}: {error}")
+    _anotar_fallido(orjson.dumps({"error": str(error), "pedido": pedido}) + b"\n")
+
+def _anotar_fallido(linea):
+    """Agrega una línea a PEDIDOS_FALLIDOS (o al log si no se puede escribir)"""
+    try:
+        with _fallidos_lock, open(PEDIDOS_FALLIDOS, 'ab') as archivo:
+            archivo.write(linea)
+    except OSError as e:
+        # Último recurso: el payload completo queda en el log
+        logger.error(f"No se pudo guardar en {PEDIDOS_FALLIDOS} ({e}). Pedido: {linea.decode('utf-8', 'replace')}")
+
+def reprocesar_pedidos_fallidos():
+    """Vuelve a guardar los pedidos de PEDIDOS_FALLIDOS; los que fallen otra vez quedan en el archivo"""
+    pendiente = PEDIDOS_FALLIDOS + '.reprocesando'
+    with _fallidos_lock:
+        # Se agrega (no se reemplaza) al archivo de un reproceso interrumpido, que se
+        # retoma aquí. Repetir un pedido es inofensivo: el INSERT ignora duplicados.
+        if os.path.exists(PEDIDOS_FALLIDOS):
+            with open(PEDIDOS_FALLIDOS, 'rb') as origen, open(pendiente, 'ab') as destino:
+                shutil.copyfileobj(origen, destino)
+            os.remove(PEDIDOS_FALLIDOS)
+        if not os.path.exists(pendiente):
+            return 0
+
+    reprocesados = 0
+    with open(pendiente, 'rb') as archivo:
+        for linea in archivo:
+            if not linea.strip():
+                continue
+            try:
+                pedido = orjson.loads(linea)["pedido"]
+            except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+                # Línea ilegible: se conserva tal cual para revisarla a mano
+                logger.error(f"Línea inválida en {PEDIDOS_FALLIDOS}: {e}")
+                _anotar_fallido(linea if linea.endswith(b"\n") else linea + b"\n")
+                continue
+            try:
+                _guardar_pedidos([pedido])
+                reprocesados += 1
+            except Exception as e:
+                _guardar_fallido(pedido, e)
+
+    # Solo al terminar todo el archivo: cada pedido ya quedó guardado o de vuelta en PEDIDOS_FALLIDOS
+    os.remove(pendiente)
+    return reprocesados
+
+@app.cli.command("reprocesar-pedidos")
+def reprocesar_pedidos_command():
+    """Reprocesa los pedidos guardados en PEDIDOS_FALLIDOS.
+
+    Uso (desde el directorio de la base de datos):
+        flask --app mi_app_tickets reprocesar-pedidos
+    """
+    reprocesados = reprocesar_pedidos_fallidos()
+    click.echo(f"{reprocesados} pedidos reprocesados.")
+    if os.path.exists(PEDIDOS_FALLIDOS):
+        click.echo(f"Quedan pedidos sin guardar en {PEDIDOS_FALLIDOS}.")
+
+def _procesar_lote(pedidos):
+    """Guarda un lote de pedidos; si falla, los reintenta uno por uno"""
+    try:
+        _guardar_pedidos(pedidos)
+    except Exception as e:
+        if len(pedidos) == 1:
+            _guardar_fallido(pedidos[0], e)
+        else:
+            logger.error(f"Error al guardar un lote de {len(pedidos)} pedidos: {e}")
+            # Reintentamos uno por uno para que un pedido malo no arrastre al resto
+            for pedido in pedidos:
+                try:
+                    _guardar_pedidos([pedido])
+                except Exception as e:
+                    _guardar_fallido(pedido, e)
+    finally:
+        for _ in pedidos:
+            _cola_pedidos.task_done()
+
+def _writer_loop():
+    """Consume la cola de pedidos y los guarda por lotes hasta recibir _FIN_COLA"""
+    activo = True
+    while activo:
+        pedidos = []
+        limite = None
+        while len(pedidos) < WEBHOOK_BATCH_SIZE:
+            try:
+                if limite is None:
+                    pedido = _cola_pedidos.get()
+                    limite = time.monotonic() + WEBHOOK_BATCH_WINDOW
+                else:
+                    pedido = _cola_pedidos.get(timeout=max(limite - time.monotonic(), 0))
+            except queue.Empty:
+                break
+
+            if pedido is _FIN_COLA:
+                _cola_pedidos.task_done()
+                activo = False
+                break
+            pedidos.append(pedido)
+
+        if pedidos:
+            _procesar_lote(pedidos)
+
+def _asegurar_writer():
+    """Arranca el hilo escritor en este proceso si todavía no está corriendo"""
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                # daemon=True para no bloquear la salida; _detener_writer (atexit) vacía la cola antes
+                _writer = threading.Thread(target=_writer_loop, name="webhook-writer", daemon=True)
+                _writer.start()
+
+def _encolar_pedido(pedido):
+    """Deja el pedido para el hilo escritor de este proceso"""
+    _asegurar_writer()
+    _cola_pedidos.put(pedido)
+
+def _reiniciar_tras_fork():
+    """En un proceso hijo (fork) descarta el estado heredado del padre"""
+    global _pool, _pool_lock, _writer, _writer_lock, _fallidos_lock, _cola_pedidos
+    # Las conexiones SQLite no se pueden usar tras un fork, y los hilos no se heredan
+    _pool = None
+    _pool_lock = threading.Lock()
+    _writer = None
+    _writer_lock = threading.Lock()
+    _fallidos_lock = threading.Lock()
+    _cola_pedidos = queue.Queue()
+
+def _detener_writer():
+    """Al salir el proceso (deploy, reinicio, reciclaje del worker) vacía la cola"""
+    if _writer is None or not _writer.is_alive():
+        return
+
+    _cola_pedidos.put(_FIN_COLA)
+    _writer.join(WEBHOOK_SHUTDOWN_TIMEOUT)
+    if not _writer.is_alive():
+        return
+
+    # El escritor no terminó a tiempo: lo que sigue en la cola se guarda para reprocesar
+    logger.error("El hilo escritor no terminó a tiempo; guardando pedidos pendientes.")
+    while True:
+        try:
+            pedido = _cola_pedidos.get_nowait()
+        except queue.Empty:
+            break
+        if pedido is not _FIN_COLA:
+            _guardar_fallido(pedido, "apagado antes de guardar")
 
 
 # --- 1. ENDPOINT: El Webhook que escucha a Shopify ---
@@ -98,70 +458,55 @@ def webhook_orden_pagada():
         logger.warning("¡ALERTA DE SEGURIDAD! HMAC inválido.")
         abort(401)
 
-    pedido = request.json
-    cliente_email = pedido.get('email')
-    orden_id = pedido.get('id')
-
-    logger.info(f"Procesando pedido: {orden_id} para {cliente_email}")
-
+    # Reutilizamos el cuerpo ya leído para el HMAC en vez de volver a pedirlo a Flask
     try:
-        db = get_db()
-        cursor = db.cursor()
-
-        for item in pedido.get('line_items', []):
-            sku = item.get('sku')
-            cantidad = item.get('quantity')
-
-            # (Usaremos la lógica de SKU por ahora, es más seguro)
-            if sku:
-                logger.info(f"Producto '{item.get('title')}' (SKU: {sku}) es un ticket. Cantidad: {cantidad}")
+        pedido = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        logger.error("Error: El cuerpo del webhook no es JSON válido.")
+        abort(400)
 
-                for i in range(cantidad):
-                    ticket_id = f"TICKET-{orden_id}-{item.get('id')}-{i+1}"
+    if not isinstance(pedido, dict):
+        logger.error("Error: El cuerpo del webhook no es un objeto JSON.")
+        abort(400)
 
-                    cursor.execute(
-                        """
-                        INSERT INTO tickets (ticket_id, evento_sku, cliente_email, orden_id, usado)
-                        VALUES (?, ?, ?, ?, 0)
-                        ON CONFLICT(ticket_id) DO NOTHING
-                        """,
-                        (ticket_id, sku, cliente_email, str(orden_id))
-                    )
-                    logger.info(f"Ticket {ticket_id} creado en la base de datos.")
+    logger.info(f"Procesando pedido: {pedido.get('id')} para {pedido.get('email')}")
 
-        db.commit()
+    # Respondemos a Shopify de inmediato; el hilo escritor guarda los tickets
+    _encolar_pedido(pedido)
 
-    except Exception as e:
-        logger.error(f"Error al procesar el pedido: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-    return jsonify({"status": "success"}), 200
+    return jsonify({"status": "queued"}), 200
 
 
 # --- 2. ENDPOINT: El Escáner de Check-in ---
 @app.route("/verificar_ticket/<path:ticket_id>")
 def verificar_ticket(ticket_id):
 
-    # Clean up whitespace from the ticket ID
-    ticket_id = ticket_id.strip()
-
-    # Support scanning full URLs: extract the last part if it looks like a URL
-    if ticket_id.startswith("http://") or ticket_id.startswith("https://"):
-        # Remove trailing slash if present
-        if ticket_id.endswith("/"):
-            ticket_id = ticket_id[:-1]
-        ticket_id = ticket_id.split("/")[-1]
-
-        # Remove query parameters if present (e.g. ?source=qr)
-        if "?" in ticket_id:
-            ticket_id = ticket_id.split("?")[0]
+    # Clean up whitespace and support scanning full URLs in one pass:
+    # keep the last path segment and drop query parameters (e.g. ?source=qr)
+    ticket_id = ticket_id.strip().rstrip("/").rsplit("/", 1)[-1].split("?", 1)[0]
 
     logger.info(f"Solicitud de verificación para: {ticket_id}")
     db = get_db()
     cursor = db.cursor()
 
-    # Esta línea era la que fallaba
-    cursor.execute("SELECT * FROM tickets WHERE ticket_id = ?", (ticket_id,))
+    # Marcado atómico: una sola sentencia (autocommit) evita la condición de carrera
+    # y la segunda ida y vuelta a SQLite en el caso normal (ticket válido).
+    # fetchall() termina la sentencia para que el cambio quede confirmado.
+    cursor.execute(
+        "UPDATE tickets SET usado = 1 WHERE ticket_id = ? AND usado = 0 RETURNING evento_sku",
+        (ticket_id,)
+    )
+    marcado = cursor.fetchall()
+
+    if marcado:
+        logger.info(f"Ticket {ticket_id} marcado como usado.")
+        return jsonify({
+            "valido": True,
+            "mensaje": f"ACCESO PERMITIDO: Ticket válido (SKU: {marcado[0]['evento_sku']})."
+        })
+
+    # No se marcó nada: o el ticket no existe o ya fue usado
+    cursor.execute("SELECT evento_sku FROM tickets WHERE ticket_id = ?", (ticket_id,))
     ticket = cursor.fetchone()
 
     if not ticket:
@@ -182,43 +527,45 @@ def verificar_ticket(ticket_id):
             "mensaje": "ACCESO DENEGADO: Ticket inválido o no existe."
         })
 
-    if ticket["usado"]:
-        return jsonify({
-            "valido": False,
-            "mensaje": f"ALERTA: Este ticket (SKU: {ticket['evento_sku']}) YA FUE USADO."
-        })
-
-    # Fix: Atomic update to prevent race condition
-    cursor.execute("UPDATE tickets SET usado = 1 WHERE ticket_id = ? AND usado = 0", (ticket_id,))
-    db.commit()
-
-    if cursor.rowcount == 0:
-        return jsonify({
-            "valido": False,
-            "mensaje": f"ALERTA: Este ticket (SKU: {ticket['evento_sku']}) YA FUE USADO."
-        })
-
-    logger.info(f"Ticket {ticket_id} marcado como usado.")
-
     return jsonify({
-        "valido": True,
-        "mensaje": f"ACCESO PERMITIDO: Ticket válido (SKU: {ticket['evento_sku']})."
+        "valido": False,
+        "mensaje": f"ALERTA: Este ticket (SKU: {ticket['evento_sku']}) YA FUE USADO."
     })
 
 # --- 3. ENDPOINT: El Cliente genera/ve su QR ---
+QR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+@functools.lru_cache(maxsize=4096)
+def _qr_png(ticket_id):
+    """Genera el PNG del QR (y su ETag) una sola vez por ticket"""
+    # scale=4 deja el PNG cerca de los 150px con que lo muestra el correo;
+    # más grande solo añade píxeles que el cliente de correo vuelve a reducir
+    # make_qr (no make): con IDs cortos segno elegiría un Micro QR, que el escáner
+    # (html5-qrcode/ZXing) no puede leer.
+    # mask=0 evita evaluar los 8 patrones de máscara (lo más caro de generar el QR);
+    # la versión se sigue eligiendo sola según el largo del ticket_id
+    memoria_img = io.BytesIO()
+    segno.make_qr(ticket_id, error='L', mask=0).save(memoria_img, kind='png', scale=4, border=4)
+    png = memoria_img.getvalue()
+    # El ETag sale de los bytes de la imagen: si cambia el renderizado, cambia el ETag
+    return png, hashlib.md5(png).hexdigest()
+
 @app.route("/generar_qr/<string:ticket_id>")
 def generar_qr(ticket_id):
     # No verificamos la BD aquí para evitar problemas de sincronización (race conditions)
     # con el webhook. Si el ID está en el correo, mostramos el QR.
     # La validación real ocurre en el escáner.
 
-    img_qr = qrcode.make(ticket_id)
+    # El QR de un ticket nunca cambia: los clientes de correo pueden guardarlo
+    png, etag = _qr_png(ticket_id)
+    cabeceras = {"Cache-Control": QR_CACHE_CONTROL, "ETag": f'"{etag}"'}
 
-    memoria_img = io.BytesIO()
-    img_qr.save(memoria_img, 'PNG')
-    memoria_img.seek(0)
+    if etag in request.if_none_match:
+        return make_response('', 304, cabeceras)
 
-    return send_file(memoria_img, mimetype='image/png')
+    response = send_file(io.BytesIO(png), mimetype='image/png')
+    response.headers.update(cabeceras)
+    return response
 
 # --- 4. ENDPOINT: Raíz (para "despertar" el servidor) ---
 @app.route("/")
@@ -228,7 +575,7 @@ def hello_world():
 # --- 5. ENDPOINT: Servir el Escáner ---
 @app.route("/escaner")
 def serve_scanner():
-    return send_file("escaner.html")
+    return send_from_directory(app.root_path, "escaner.html", conditional=True, max_age=3600)
 
 
 # --- Ejecución de la App ---
@@ -237,6 +584,9 @@ def serve_scanner():
 # Llamamos a init_db() aquí, fuera del bloque __name__
 # Esto asegura que gunicorn (Render) SIEMPRE cree la tabla al iniciar.
 init_db()
+atexit.register(_detener_writer)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_tras_fork)
 
 if __name__ == '__main__':
     # El init_db() ya se llamó arriba
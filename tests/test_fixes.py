@@ -2,27 +2,43 @@ import unittest
 import threading
 import os
 import sys
-import requests
-import time
+import json
+import sqlite3
+import tempfile
 import subprocess
+import hmac
+import hashlib
+import base64
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import mi_app_tickets
 from mi_app_tickets import app, init_db
 
-# We need a separate process for the race condition test because it uses requests against a running server
-# But for the QR test, we can use the flask test client.
-
 class TestTicketSystem(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
         self.app.testing = True
-        # Ensure a clean DB for testing
-        if os.path.exists('tickets.db'):
-            os.remove('tickets.db')
+        # Ensure a clean DB for testing (including WAL side files)
+        for path in ('tickets.db', 'tickets.db-wal', 'tickets.db-shm'):
+            if os.path.exists(path):
+                os.remove(path)
         # Initialize DB
         init_db()
 
     def tearDown(self):
-        if os.path.exists('tickets.db'):
-            os.remove('tickets.db')
+        for path in ('tickets.db', 'tickets.db-wal', 'tickets.db-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _insertar_ticket(self, ticket_id, sku):
+        """Inserts an unused ticket directly into the test database."""
+        conn = sqlite3.connect('tickets.db')
+        conn.execute(
+            "INSERT INTO tickets (ticket_id, evento_sku, cliente_email, orden_id, usado) VALUES (?, ?, ?, ?, 0)",
+            (ticket_id, sku, 'test@example.com', 'ORDER-TEST')
+        )
+        conn.commit()
+        conn.close()
 
     def test_qr_generation_always_succeeds(self):
         """
@@ -34,75 +50,63 @@ class TestTicketSystem(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.mimetype, 'image/png')
 
+    def test_short_ticket_id_gives_regular_qr(self):
+        """
+        Test that short ids are not rendered as Micro QR, which the scanner cannot read.
+        """
+        response = self.app.get('/generar_qr/TEST-1')
+        self.assertEqual(response.status_code, 200)
+        # PNG width (IHDR) in modules; Micro QR tops out at 17 modules, regular QR starts at 21
+        width = int.from_bytes(response.data[16:20], 'big')
+        self.assertGreaterEqual(width // 4 - 2 * 4, 21)
+
+    def test_qr_revalidation_returns_304(self):
+        """
+        Test that the QR is served with a stable ETag and a conditional request gets a 304.
+        """
+        first = self.app.get('/generar_qr/TICKET-ETAG-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('immutable', first.headers['Cache-Control'])
+        etag = first.headers['ETag']
+
+        second = self.app.get('/generar_qr/TICKET-ETAG-1', headers={'If-None-Match': etag})
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.data, b'')
+
+        # The validator describes the image bytes, not just the ticket id
+        self.assertEqual(etag, '"%s"' % hashlib.md5(first.data).hexdigest())
+
     def test_race_condition_prevention(self):
         """
         Test that multiple concurrent requests cannot redeem the same ticket twice.
         This verifies the atomic update fix.
         """
         # 1. Create a valid ticket in the DB
-        with app.app_context():
-            import sqlite3
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO tickets (ticket_id, evento_sku, cliente_email, orden_id, usado) VALUES (?, ?, ?, ?, 0)",
-                ('RACE-TEST-TICKET', 'SKU-123', 'race@example.com', 'ORDER-RACE')
-            )
-            conn.commit()
-            conn.close()
+        self._insertar_ticket('RACE-TEST-TICKET', 'SKU-123')
 
-        # 2. Launch server in a separate process
-        server_process = subprocess.Popen(
-            [sys.executable, 'mi_app_tickets.py'],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        time.sleep(2) # Wait for server to start
+        # 2. Fire concurrent requests; the barrier releases all threads at once
+        workers = 5
+        barrier = threading.Barrier(workers)
 
-        try:
-            url = "http://localhost:8080/verificar_ticket/RACE-TEST-TICKET"
-            results = []
-
-            def call_endpoint():
-                try:
-                    res = requests.get(url)
-                    results.append(res.json())
-                except Exception as e:
-                    results.append({"error": str(e)})
-
-            # 3. Fire concurrent requests
-            threads = []
-            for _ in range(5):
-                t = threading.Thread(target=call_endpoint)
-                threads.append(t)
-                t.start()
-
-            for t in threads:
-                t.join()
-
-            # 4. Verify only one success
-            success_count = sum(1 for r in results if r.get('valido') is True)
-            self.assertEqual(success_count, 1, f"Expected 1 success, got {success_count}. Results: {results}")
+        def call_endpoint():
+            client = app.test_client()
+            barrier.wait()
+            return client.get('/verificar_ticket/RACE-TEST-TICKET').get_json()
 
-        finally:
-            server_process.terminate()
-            server_process.wait()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(call_endpoint) for _ in range(workers)]
+            results = [future.result() for future in futures]
+
+        # 3. Verify only one success
+        success_count = sum(1 for r in results if r.get('valido') is True)
+        self.assertEqual(success_count, 1, f"Expected 1 success, got {success_count}. Results: {results}")
 
     def test_whitespace_sanitization(self):
         """
         Test that trailing whitespace in the verification request is ignored/sanitized.
         """
         # 1. Create a ticket "TEST-SPACE"
-        with app.app_context():
-            import sqlite3
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO tickets (ticket_id, evento_sku, cliente_email, orden_id, usado) VALUES (?, ?, ?, ?, 0)",
-                ('TEST-SPACE', 'SKU-SPACE', 'space@example.com', 'ORDER-SPACE')
-            )
-            conn.commit()
-            conn.close()
+        self._insertar_ticket('TEST-SPACE', 'SKU-SPACE')
 
         # 2. Request verification with trailing space: "TEST-SPACE "
         # We manually construct the URL with encoded space to ensure it reaches the server as intended
@@ -114,6 +118,244 @@ class TestTicketSystem(unittest.TestCase):
         self.assertTrue(data['valido'], "Verification failed despite whitespace fix")
         self.assertIn("ACCESO PERMITIDO", data['mensaje'])
 
+    def test_second_scan_reports_ticket_used(self):
+        """
+        Test that a ticket is accepted once and rejected as used afterwards.
+        """
+        self._insertar_ticket('USED-TICKET', 'SKU-USED')
+
+        first = self.app.get('/verificar_ticket/USED-TICKET').get_json()
+        second = self.app.get('/verificar_ticket/USED-TICKET').get_json()
+
+        self.assertTrue(first['valido'])
+        self.assertIn("SKU-USED", first['mensaje'])
+        self.assertFalse(second['valido'])
+        self.assertIn("YA FUE USADO", second['mensaje'])
+
+    def test_webhook_creates_one_ticket_per_unit(self):
+        """
+        Test that a signed order webhook inserts one ticket per purchased unit.
+        """
+        secret = 'test-secret'
+        payload = json.dumps({
+            'id': 555,
+            'email': 'buyer@example.com',
+            'line_items': [
+                {'id': 1, 'sku': 'SKU-A', 'quantity': 3, 'title': 'Entrada A'},
+                {'id': 2, 'sku': None, 'quantity': 1, 'title': 'Camiseta'},
+            ]
+        }).encode('utf-8')
+        firma = base64.b64encode(hmac.new(secret.encode('utf-8'), payload, hashlib.sha256).digest())
+
+        plantilla = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+        with mock.patch.object(mi_app_tickets, '_HMAC_TEMPLATE', plantilla):
+            response = self.app.post(
+                '/shopify/webhook/orden_pagada',
+                data=payload,
+                content_type='application/json',
+                headers={'X-Shopify-Hmac-Sha256': firma.decode('ascii')}
+            )
+        self.assertEqual(response.status_code, 200)
+        # Tickets are written by the background writer thread
+        mi_app_tickets._cola_pedidos.join()
+
+        conn = sqlite3.connect('tickets.db')
+        ids = [row[0] for row in conn.execute("SELECT ticket_id FROM tickets ORDER BY ticket_id")]
+        conn.close()
+        self.assertEqual(ids, ['TICKET-555-1-1', 'TICKET-555-1-2', 'TICKET-555-1-3'])
+
+    def test_webhook_rejects_signed_non_object_body(self):
+        """
+        Test that correctly signed bodies that are not a JSON object are rejected with 400.
+        """
+        plantilla = hmac.new(b'test-secret', digestmod=hashlib.sha256)
+
+        with mock.patch.object(mi_app_tickets, '_HMAC_TEMPLATE', plantilla):
+            for payload in (b'[1, 2]', b'not json', b''):
+                firma = base64.b64encode(hmac.new(b'test-secret', payload, hashlib.sha256).digest())
+                response = self.app.post(
+                    '/shopify/webhook/orden_pagada',
+                    data=payload,
+                    content_type='application/json',
+                    headers={'X-Shopify-Hmac-Sha256': firma.decode('ascii')}
+                )
+                self.assertEqual(response.status_code, 400)
+
+    def test_queued_orders_are_written_on_shutdown(self):
+        """
+        Test that orders still queued when the process exits are saved before it ends.
+        """
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = (
+            "import sys; sys.path.insert(0, %r)\n"
+            "import mi_app_tickets\n"
+            "for n in range(20):\n"
+            "    mi_app_tickets._encolar_pedido({'id': n, 'email': 'x@example.com',\n"
+            "        'line_items': [{'id': 1, 'sku': 'SKU-EXIT', 'quantity': 50}]})\n"
+        ) % repo
+
+        with tempfile.TemporaryDirectory() as tmp:
+            subprocess.run([sys.executable, '-c', script], cwd=tmp, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            conn = sqlite3.connect(os.path.join(tmp, 'tickets.db'))
+            count = conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+            conn.close()
+
+        self.assertEqual(count, 1000)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requires os.fork")
+    def test_orders_written_in_worker_forked_after_import(self):
+        """
+        Test that a worker forked after import (gunicorn --preload) still writes its orders.
+        """
+        repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        script = (
+            "import os, sys; sys.path.insert(0, %r)\n"
+            "import mi_app_tickets\n"
+            "assert mi_app_tickets._pool is None and mi_app_tickets._writer is None\n"
+            "pid = os.fork()\n"
+            "if pid == 0:\n"
+            "    mi_app_tickets._encolar_pedido({'id': 9, 'email': 'x@example.com',\n"
+            "        'line_items': [{'id': 1, 'sku': 'SKU-FORK', 'quantity': 3}]})\n"
+            "else:\n"
+            "    assert os.waitpid(pid, 0)[1] == 0\n"
+        ) % repo
+
+        with tempfile.TemporaryDirectory() as tmp:
+            subprocess.run([sys.executable, '-c', script], cwd=tmp, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            conn = sqlite3.connect(os.path.join(tmp, 'tickets.db'))
+            count = conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+            conn.close()
+
+        self.assertEqual(count, 3)
+
+    def test_failed_order_is_kept_for_replay(self):
+        """
+        Test that an order the writer cannot store is saved to disk and can be replayed.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            fallidos = os.path.join(tmp, 'pedidos_fallidos.jsonl')
+            pedido = {'id': 777, 'email': 'fail@example.com',
+                      'line_items': [{'id': 1, 'sku': 'SKU-FAIL', 'quantity': 2}]}
+
+            with mock.patch.object(mi_app_tickets, 'PEDIDOS_FALLIDOS', fallidos), \
+                    mock.patch.object(mi_app_tickets, '_guardar_pedidos', side_effect=sqlite3.OperationalError('disk I/O error')):
+                mi_app_tickets._encolar_pedido(pedido)
+                mi_app_tickets._cola_pedidos.join()
+
+            with open(fallidos) as archivo:
+                guardado = json.loads(archivo.readline())
+            self.assertEqual(guardado['pedido'], pedido)
+
+            # Replayed through the CLI command operators run: flask --app mi_app_tickets reprocesar-pedidos
+            with mock.patch.object(mi_app_tickets, 'PEDIDOS_FALLIDOS', fallidos):
+                result = app.test_cli_runner().invoke(args=['reprocesar-pedidos'])
+            self.assertIn('1 pedidos reprocesados', result.output)
+            self.assertFalse(os.path.exists(fallidos))
+
+        conn = sqlite3.connect('tickets.db')
+        count = conn.execute("SELECT COUNT(*) FROM tickets WHERE orden_id = '777'").fetchone()[0]
+        conn.close()
+        self.assertEqual(count, 2)
+
+    def test_webhook_rejects_bad_signature(self):
+        """
+        Test that wrong or malformed HMAC headers are rejected with 401.
+        """
+        plantilla = hmac.new(b'test-secret', digestmod=hashlib.sha256)
+        payload = json.dumps({'id': 1, 'line_items': []}).encode('utf-8')
+        otra_firma = base64.b64encode(hmac.new(b'other-secret', payload, hashlib.sha256).digest()).decode('ascii')
+
+        with mock.patch.object(mi_app_tickets, '_HMAC_TEMPLATE', plantilla):
+            for cabecera in (otra_firma, 'not base64!!', otra_firma * 100):
+                response = self.app.post(
+                    '/shopify/webhook/orden_pagada',
+                    data=payload,
+                    content_type='application/json',
+                    headers={'X-Shopify-Hmac-Sha256': cabecera}
+                )
+                self.assertEqual(response.status_code, 401)
+
+    def test_scanned_url_is_reduced_to_ticket_id(self):
+        """
+        Test that scanning a full QR URL verifies the ticket id at the end of it.
+        """
+        self._insertar_ticket('URL-TICKET', 'SKU-URL')
+
+        response = self.app.get('/verificar_ticket/https://example.com/generar_qr/URL-TICKET/')
+        data = response.get_json()
+
+        self.assertTrue(data['valido'])
+        self.assertIn("SKU-URL", data['mensaje'])
+
+    def test_json_dates_keep_flask_format(self):
+        """
+        Test that the orjson provider still renders dates in Flask's HTTP-date format.
+        """
+        import datetime
+        with app.app_context():
+            encoded = app.json.dumps({'fecha': datetime.datetime(2026, 1, 2, 3, 4, 5)})
+        self.assertEqual(encoded, '{"fecha":"Fri, 02 Jan 2026 03:04:05 GMT"}')
+
+    def test_json_keys_sorted_and_stringified(self):
+        """
+        Test that the orjson provider sorts keys and accepts non-str keys like Flask's default.
+        """
+        with app.app_context():
+            encoded = app.json.dumps({'b': 1, 'a': 2, 3: 'x'})
+        self.assertEqual(encoded, '{"3":"x","a":2,"b":1}')
+
+    def test_replay_resumes_interrupted_run_and_keeps_bad_lines(self):
+        """
+        Test that replaying picks up a leftover file from an interrupted run and keeps unreadable lines.
+        """
+        def linea(orden_id):
+            pedido = {'id': orden_id, 'email': 'r@example.com',
+                      'line_items': [{'id': 1, 'sku': 'SKU-R', 'quantity': 1}]}
+            return json.dumps({'error': 'x', 'pedido': pedido}) + '\n'
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fallidos = os.path.join(tmp, 'pedidos_fallidos.jsonl')
+            with open(fallidos + '.reprocesando', 'w') as archivo:
+                archivo.write('{not json\n' + linea(2))
+            with open(fallidos, 'w') as archivo:
+                archivo.write(linea(3))
+
+            with mock.patch.object(mi_app_tickets, 'PEDIDOS_FALLIDOS', fallidos):
+                self.assertEqual(mi_app_tickets.reprocesar_pedidos_fallidos(), 2)
+
+            self.assertFalse(os.path.exists(fallidos + '.reprocesando'))
+            with open(fallidos) as archivo:
+                self.assertEqual(archivo.read(), '{not json\n')
+
+        conn = sqlite3.connect('tickets.db')
+        ordenes = [row[0] for row in conn.execute("SELECT orden_id FROM tickets ORDER BY orden_id")]
+        conn.close()
+        self.assertEqual(ordenes, ['2', '3'])
+
+    def test_db_connections_returned_to_pool(self):
+        """
+        Test that each request gives its pooled connection back on teardown.
+        """
+        for _ in range(mi_app_tickets.DB_POOL_SIZE + 1):
+            self.app.get('/verificar_ticket/NOPE')
+        self.assertEqual(mi_app_tickets._pool.qsize(), mi_app_tickets.DB_POOL_SIZE)
+
+    def test_exhausted_pool_returns_503(self):
+        """
+        Test that a request fails with 503 instead of hanging when no connection is free.
+        """
+        pool = mi_app_tickets._obtener_pool()
+        tomadas = [pool.get_nowait() for _ in range(mi_app_tickets.DB_POOL_SIZE)]
+        try:
+            with mock.patch.object(mi_app_tickets, 'DB_POOL_TIMEOUT', 0.01):
+                response = self.app.get('/verificar_ticket/NOPE')
+            self.assertEqual(response.status_code, 503)
+        finally:
+            for db in tomadas:
+                pool.put(db)
+
     def test_scanner_page_served(self):
         """
         Test that the scanner HTML is served at /escaner
@@ -122,5 +364,17 @@ class TestTicketSystem(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Scanner de Eventos v3', response.data)
 
+        revalidation = self.app.get('/escaner', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(revalidation.status_code, 304)
+
+        # Browsers always send Accept-Encoding: the compressed copy must revalidate too
+        compressed = self.app.get('/escaner', headers={'Accept-Encoding': 'br, gzip'})
+        self.assertEqual(compressed.headers['Content-Encoding'], 'br')
+        revalidation = self.app.get('/escaner', headers={
+            'Accept-Encoding': 'br, gzip',
+            'If-None-Match': compressed.headers['ETag']
+        })
+        self.assertEqual(revalidation.status_code, 304)
+
 if __name__ == '__main__':
     unittest.main()